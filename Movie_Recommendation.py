@@ -20,22 +20,66 @@ spark = SparkSession.builder.appName("Movie_Recommendations").getOrCreate()
 from pyspark.sql.functions import regexp_extract
 from pyspark.sql.types import *
 
-raw_ratings_df =  spark.read.csv('/FileStore/tables/ratings.csv',header = True ,  schema = ratings_df_schema)
-ratings_df = raw_ratings_df.drop('Timestamp')
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Parsing the 20M line `ratings.csv` on every run, and then counting it again just to check the row counts, makes a cold start take minutes. Instead we ingest each CSV once into a Parquet store with compact types (int32 ids, float32 ratings). Next to the data we record the row count, a checksum and the size and modification time of the source file in `_ingest_meta.json`. A CSV is only ingested again when the source file changes, and the counts used below come from that metadata rather than from a scan.
+
+# COMMAND ----------
+
+import os
+import json
+import time
+from pyspark.sql import functions as F
+
+ingest_path = '/FileStore/ingested'
+
+def source_fingerprint(csv_path):
+  stat = os.stat('/dbfs' + csv_path)
+  return {'path': csv_path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def ingest_csv(name, csv_path, schema, columns, partition_col, partitions):
+  table_path = '%s/%s' % (ingest_path, name)
+  meta_file = '/dbfs%s/_ingest_meta.json' % table_path
+  source = source_fingerprint(csv_path)
+
+  meta = None
+  if os.path.exists(meta_file):
+    with open(meta_file) as f:
+      meta = json.load(f)
 
-raw_movies_df = spark.read.csv('/FileStore/tables/movies.csv',header = True ,  schema = movies_df_schema)
-movies_df = raw_movies_df.drop('Genres').withColumnRenamed('movieId', 'ID')
+  if meta is None or meta['source'] != source:
+    raw_df = spark.read.csv(csv_path, header=True, schema=schema).select(columns)
+    # Sorting inside the partitions keeps the Parquet min/max statistics tight, so filters on ids skip most row groups
+    raw_df.repartition(partitions, partition_col)\
+          .sortWithinPartitions(partition_col)\
+          .write.mode('overwrite').parquet(table_path)
 
-ratings_df.cache()
+    # Files starting with "_" are ignored by Spark, so the metadata can live next to the data
+    stored_df = spark.read.parquet(table_path)
+    stats = stored_df.agg(F.count(F.lit(1)).alias('rows'),
+                          F.sum(F.hash(*stored_df.columns).cast('long')).alias('checksum')).first()
+    meta = {'source': source, 'rows': stats['rows'], 'checksum': stats['checksum'], 'ingested_at': time.time()}
+    with open(meta_file, 'w') as f:
+      json.dump(meta, f)
+    print ('Ingested %s rows from %s' % (meta['rows'], csv_path))
+
+  return spark.read.parquet(table_path), meta
+
+# COMMAND ----------
+
+ratings_df, ratings_meta = ingest_csv('ratings', '/FileStore/tables/ratings.csv', ratings_df_schema,
+                                      [F.col('userId'), F.col('movieId'), F.col('rating').cast('float')], 'userId', 64)
+movies_df, movies_meta = ingest_csv('movies', '/FileStore/tables/movies.csv', movies_df_schema,
+                                    [F.col('ID'), F.col('title')], 'ID', 1)
+
+# The ratings are read straight from Parquet; the splits we train on are cached further below
 movies_df.cache()
 
-assert ratings_df.is_cached
 assert movies_df.is_cached
 
-raw_ratings_count = raw_ratings_df.count()
-ratings_count = ratings_df.count()
-raw_movies_count = raw_movies_df.count()
-movies_count = movies_df.count()
+ratings_count = ratings_meta['rows']
+movies_count = movies_meta['rows']
 
 print ('There are %s ratings and %s movies in the datasets' % (ratings_count, movies_count))
 print ('Ratings:')
@@ -43,9 +87,6 @@ ratings_df.show(3)
 print ('Movies:')
 movies_df.show(3, truncate=False)
 
-assert raw_ratings_count == ratings_count
-assert raw_movies_count == movies_count
-
 # COMMAND ----------
 
 # MAGIC %md Next, let's do a quick verification of the data.
@@ -72,16 +113,89 @@ display(ratings_df)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Aggregating all 20M ratings on every run just to rank the movies is wasteful, because the ranking only changes when new ratings arrive. We materialize a per-movie aggregate table with the number of ratings (`count`) and their `sum`, so a new batch of ratings is merged into the 27k row table instead of rescanning the ratings. Every version of the table is written to its own directory, and `_popularity_meta.json` points at the current one. The metadata also holds the global totals and a precomputed top-N list, so cold-start and fallback recommendations are a file read rather than a cluster job.
+
+# COMMAND ----------
+
 from pyspark.sql import functions as F
 
-# From ratingsDF, create a movie_ids_with_avg_ratings_df that combines the two DataFrames
-movie_ids_with_avg_ratings_df = ratings_df.groupBy('movieId').agg(F.count(ratings_df.rating).alias("count"), F.avg(ratings_df.rating).alias("average"))
+popularity_path = '/FileStore/popularity'
+prior_weight = 500
+# Enough for the largest fallback list the recommendation service returns
+popularity_top_n = 1000
+
+def popularity_meta_file(path):
+  return '/dbfs%s/_popularity_meta.json' % path
+
+def read_popularity_meta(path=popularity_path):
+  if not os.path.exists(popularity_meta_file(path)):
+    return None
+  with open(popularity_meta_file(path)) as f:
+    return json.load(f)
+
+def aggregate_ratings(df):
+  return df.groupBy('movieId').agg(F.count('rating').alias('count'), F.sum('rating').cast('double').alias('sum'))
+
+def score_popularity(aggregate_df, meta):
+  # Damped mean: every movie starts with prior_weight ratings at the global average
+  global_average = meta['sum'] / meta['count']
+  return aggregate_df.withColumn('average', F.col('sum') / F.col('count'))\
+                     .withColumn('score', (F.col('sum') + meta['prior_weight'] * global_average) / (F.col('count') + meta['prior_weight']))
+
+def write_popularity(aggregate_df, version, ratings_checksum, top_n=popularity_top_n, path=popularity_path):
+  table_path = '%s/v%s' % (path, version)
+  aggregate_df.write.mode('overwrite').parquet(table_path)
+  aggregate_df = spark.read.parquet(table_path)
+
+  totals = aggregate_df.agg(F.sum('count').alias('count'), F.sum('sum').alias('sum')).first()
+  meta = {'version': version, 'table_path': table_path, 'ratings_checksum': ratings_checksum,
+          'count': totals['count'], 'sum': totals['sum'], 'prior_weight': prior_weight, 'top_n_limit': top_n}
+  top_df = score_popularity(aggregate_df, meta).join(movies_df, F.col('movieId') == movies_df.ID)\
+                                               .orderBy(F.desc('score')).limit(top_n)
+  meta['top_n'] = [row.asDict() for row in top_df.select('movieId', 'title', 'count', 'average', 'score').collect()]
+
+  # The previous version is kept, so DataFrames that readers already built on it keep working
+  # until the next update; only the version before that one is removed
+  previous_meta = read_popularity_meta(path)
+  if previous_meta is not None and previous_meta['table_path'] != table_path:
+    meta['previous_table_path'] = previous_meta['table_path']
+  # Swapped in with os.replace, so a reader never sees a half written metadata file
+  os.makedirs(os.path.dirname(popularity_meta_file(path)), exist_ok=True)
+  with open(popularity_meta_file(path) + '.tmp', 'w') as f:
+    json.dump(meta, f)
+  os.replace(popularity_meta_file(path) + '.tmp', popularity_meta_file(path))
+  if previous_meta is not None and previous_meta.get('previous_table_path') not in (None, table_path):
+    dbutils.fs.rm(previous_meta['previous_table_path'], True)
+  return meta
+
+def build_popularity(ratings_df, ratings_checksum, path=popularity_path):
+  # A new version directory, so the table being read is never overwritten
+  meta = read_popularity_meta(path)
+  version = 0 if meta is None else meta['version'] + 1
+  return write_popularity(aggregate_ratings(ratings_df), version, ratings_checksum, path=path)
+
+def update_popularity(new_ratings_df, path=popularity_path):
+  # Only the new batch and the small aggregate table are read
+  meta = read_popularity_meta(path)
+  current_df = spark.read.parquet(meta['table_path'])
+  merged_df = current_df.unionByName(aggregate_ratings(new_ratings_df))\
+                        .groupBy('movieId').agg(F.sum('count').alias('count'), F.sum('sum').alias('sum'))
+  return write_popularity(merged_df, meta['version'] + 1, meta['ratings_checksum'], meta['top_n_limit'], path)
+
+# The table is only rebuilt from scratch when the ingested ratings or the length of the top-N list changed
+popularity_meta = read_popularity_meta()
+if popularity_meta is None or popularity_meta['ratings_checksum'] != ratings_meta['checksum'] \
+    or popularity_meta.get('top_n_limit') != popularity_top_n:
+  popularity_meta = build_popularity(ratings_df, ratings_meta['checksum'])
+
+movie_ids_with_avg_ratings_df = score_popularity(spark.read.parquet(popularity_meta['table_path']), popularity_meta)
 print ('movie_ids_with_avg_ratings_df:')
 movie_ids_with_avg_ratings_df.show(3, truncate=False)
 
 
 movie_names_df = movie_ids_with_avg_ratings_df.join(movies_df,movie_ids_with_avg_ratings_df.movieId == movies_df.ID)
-movie_names_with_avg_ratings_df = movie_names_df.select(['average','title','count','movieId'])
+movie_names_with_avg_ratings_df = movie_names_df.select(['average','title','count','movieId','score'])
 
 print ('movie_names_with_avg_ratings_df:')
 movie_names_with_avg_ratings_df.show(3, truncate=False)
@@ -92,7 +206,7 @@ movie_names_with_avg_ratings_df.show(3, truncate=False)
 
 # COMMAND ----------
 
-movies_with_500_ratings_or_more = movie_names_with_avg_ratings_df.filter(F.col('count')>500).sort('count', ascending=False)
+movies_with_500_ratings_or_more = movie_names_with_avg_ratings_df.filter(F.col('count')>=500).sort('average', ascending=False)
 print ('Movies with highest ratings:')
 movies_with_500_ratings_or_more.show(20, truncate=False)
 
@@ -100,6 +214,51 @@ movies_with_500_ratings_or_more.show(20, truncate=False)
 
 # MAGIC %md This is called as popularity based Recommendation.
 # MAGIC Using a threshold on the number of reviews is one way to improve the recommendations, but there are many other good ways to improve quality. For example, you could weight ratings by the number of ratings.
+# MAGIC 
+# MAGIC That is what the `score` column does: it is the average rating after adding `prior_weight` ratings at the global average, so a movie needs many ratings before its own average dominates. The precomputed top-N list by `score` is read straight from the metadata, without a Spark job.
+
+# COMMAND ----------
+
+def popular_movies(n=20):
+  return read_popularity_meta()['top_n'][:n]
+
+print ('Movies with the highest damped average rating:')
+for movie in popular_movies(20):
+  print ('%.3f  %5d  %s' % (movie['score'], movie['count'], movie['title']))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC New ratings are merged with `update_popularity`. DataFrames built on the previous version, like `movie_names_with_avg_ratings_df` above, keep working until the next update, but they do not see the new ratings; re-read `table_path` from the metadata to pick them up.
+# MAGIC 
+# MAGIC We check the incremental path on a scratch copy of the table, so the real table never sees the made-up batch: 1000 five-star ratings for the last movie of the top-N list must raise its count by 1000 and its sum by 5000, raise the global totals by the same amounts, and raise its score.
+
+# COMMAND ----------
+
+scratch_path = popularity_path + '_check'
+dbutils.fs.rm(scratch_path, True)
+scratch_meta = write_popularity(spark.read.parquet(popularity_meta['table_path']), 0,
+                                popularity_meta['ratings_checksum'], path=scratch_path)
+movie = scratch_meta['top_n'][-1]
+batch_df = spark.createDataFrame([(-user_id, movie['movieId'], 5.0) for user_id in range(1, 1001)],
+                                 'userId int, movieId int, rating float')
+updated_meta = update_popularity(batch_df, scratch_path)
+
+# The previous version is still readable after the update
+before = spark.read.parquet(scratch_meta['table_path']).filter(F.col('movieId') == movie['movieId']).first()
+after = spark.read.parquet(updated_meta['table_path']).filter(F.col('movieId') == movie['movieId']).first()
+assert updated_meta['version'] == scratch_meta['version'] + 1
+assert after['count'] == before['count'] + 1000
+assert abs(after['sum'] - before['sum'] - 5000) < 1e-6
+assert updated_meta['count'] == scratch_meta['count'] + 1000
+assert abs(updated_meta['sum'] - scratch_meta['sum'] - 5000) < 1e-6
+
+updated_movie = [m for m in updated_meta['top_n'] if m['movieId'] == movie['movieId']]
+assert updated_movie and updated_movie[0]['score'] > movie['score']
+assert [m['score'] for m in updated_meta['top_n']] == sorted([m['score'] for m in updated_meta['top_n']], reverse=True)
+print ('%s: score %.3f -> %.3f after the update' % (movie['title'], movie['score'], updated_movie[0]['score']))
+
+dbutils.fs.rm(scratch_path, True)
 
 # COMMAND ----------
 
@@ -165,7 +324,7 @@ test_df.show(3)
 # MAGIC 
 # MAGIC Using the ML Pipeline's CrossValidator with ALS is thus problematic, because cross validation involves dividing the training data into a set of folds (e.g., three sets) and then using those folds for testing and evaluating the parameters during the parameter grid search process. It is likely that some of the folds will contain users that are not in the other folds, and, as a result, ALS produces NaN values for those new users. When the CrossValidator uses the Evaluator (RMSE) to compute an error metric, the RMSE algorithm will return NaN. This will make all of the parameters in the parameter grid appear to be equally good (or bad).
 # MAGIC 
-# MAGIC You can read the discussion on Spark JIRA 14489 about this issue. There are proposed workarounds of having ALS provide default values or having RMSE drop NaN values. Both introduce potential issues. We have chosen to have RMSE drop NaN values. While this does not solve the underlying issue of ALS not predicting a value for a new user, it does provide some evaluation value. We manually implement the parameter grid search process using a for loop (below) and remove the NaN values before using RMSE.
+# MAGIC You can read the discussion on Spark JIRA 14489 about this issue. There are proposed workarounds of having ALS provide default values or having RMSE drop NaN values. Both introduce potential issues. We have chosen to have RMSE drop NaN values. While this does not solve the underlying issue of ALS not predicting a value for a new user, it does provide some evaluation value. We manually implement the parameter grid search process (below) and remove the NaN values before using RMSE.
 # MAGIC 
 # MAGIC For a production application, you would want to consider the tradeoffs in how to handle new users.
 
@@ -183,43 +342,144 @@ als.setMaxIter(5)\
   .setItemCol("movieId")\
   .setRatingCol("rating")
 
-# Now let's compute an evaluation metric for our test dataset
-from pyspark.ml.evaluation import RegressionEvaluator
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC A `RegressionEvaluator` computes a single metric per `model.transform` and per pass over the data. `evaluate_model` instead transforms the data once, caches the predictions, and computes all of the metrics below in one aggregation:
+# MAGIC 
+# MAGIC - RMSE and MAE over the rows the model could predict. NaN predictions (due to SPARK-14489) are left out of these. They are found with isnan(); unlike Python, Spark SQL treats NaN = NaN as true, so comparing with NaN works too, but isnan() states the intent directly.
+# MAGIC - `coverage`, the fraction of rows with a prediction, and `cold_start_rows`, the number of rows without one.
+# MAGIC - precision@K, recall@K, NDCG@K and MAP@K, ranking each user's held-out movies by predicted rating and counting a movie as relevant when it was rated at least `relevant_rating`. They are averaged over the users with at least one relevant movie.
+# MAGIC - `baseline_rmse`, the RMSE of a constant `baseline` prediction over all rows, when a baseline is given.
+# MAGIC 
+# MAGIC The cached predictions are returned next to the metrics; call `unpersist()` on them when done.
+
+# COMMAND ----------
+
+from pyspark.sql import Window
+
+def evaluate_model(model, df, k=10, relevant_rating=4.0, baseline=None):
+  predict_df = model.transform(df).cache()
+
+  predicted = ~F.isnan('prediction')
+  relevant = (F.col('rating') >= relevant_rating).cast('int')
+  by_prediction = Window.partitionBy('userId').orderBy(F.desc(F.when(predicted, F.col('prediction'))))
+  by_rating = Window.partitionBy('userId').orderBy(F.desc(F.when(predicted, F.col('rating'))))
+  scored_df = predict_df.withColumn('relevant', relevant)\
+                        .withColumn('position', F.row_number().over(by_prediction))\
+                        .withColumn('ideal_position', F.row_number().over(by_rating))\
+                        .withColumn('hits_so_far', F.sum('relevant').over(by_prediction.rowsBetween(Window.unboundedPreceding, Window.currentRow)))
+
+  in_top_k = predicted & (F.col('position') <= k)
+  in_ideal_top_k = predicted & (F.col('ideal_position') <= k)
+  error = F.col('prediction') - F.col('rating')
+  per_user_df = scored_df.groupBy('userId').agg(
+    F.count(F.lit(1)).alias('rows'),
+    F.sum(predicted.cast('int')).alias('predicted'),
+    F.sum(F.when(predicted, error * error)).alias('squared_error'),
+    F.sum(F.when(predicted, F.abs(error))).alias('absolute_error'),
+    F.sum(F.when(predicted, F.col('relevant'))).alias('relevant'),
+    F.sum(F.when(in_top_k, F.col('relevant'))).alias('hits'),
+    F.sum(F.when(in_top_k, F.col('relevant') / F.log2(F.col('position') + 1))).alias('dcg'),
+    F.sum(F.when(in_ideal_top_k, F.col('relevant') / F.log2(F.col('ideal_position') + 1))).alias('ideal_dcg'),
+    # Users without a hit in the top K still count, with an average precision of 0
+    F.sum(F.when(in_top_k & (F.col('relevant') == 1), F.col('hits_so_far') / F.col('position')).otherwise(0.0)).alias('precision_sum'),
+    F.sum((F.col('rating') - F.lit(baseline if baseline is not None else 0.0)) ** 2).alias('baseline_squared_error'))
+
+  has_relevant = F.col('relevant') > 0
+  totals = per_user_df.agg(
+    F.sum('rows').alias('rows'),
+    F.sum('predicted').alias('predicted'),
+    F.sum('squared_error').alias('squared_error'),
+    F.sum('absolute_error').alias('absolute_error'),
+    F.sum('baseline_squared_error').alias('baseline_squared_error'),
+    F.avg(F.when(has_relevant, F.col('hits') / k)).alias('precision'),
+    F.avg(F.when(has_relevant, F.col('hits') / F.col('relevant'))).alias('recall'),
+    F.avg(F.when(has_relevant, F.col('dcg') / F.col('ideal_dcg'))).alias('ndcg'),
+    F.avg(F.when(has_relevant, F.col('precision_sum') / F.least(F.col('relevant'), F.lit(k)))).alias('map')).first()
+
+  predicted_rows = totals['predicted'] or 0
+  metrics = {
+    'rmse': (totals['squared_error'] / predicted_rows) ** 0.5 if predicted_rows else float('nan'),
+    'mae': totals['absolute_error'] / predicted_rows if predicted_rows else float('nan'),
+    'coverage': predicted_rows / totals['rows'] if totals['rows'] else float('nan'),
+    'cold_start_rows': (totals['rows'] or 0) - predicted_rows,
+    'precision@%s' % k: totals['precision'],
+    'recall@%s' % k: totals['recall'],
+    'ndcg@%s' % k: totals['ndcg'],
+    'map@%s' % k: totals['map']}
+  if baseline is not None:
+    metrics['baseline_rmse'] = (totals['baseline_squared_error'] / totals['rows']) ** 0.5
+  return metrics, predict_df
+
+# COMMAND ----------
 
-# Create an RMSE evaluator using the label and predicted columns
-reg_eval = RegressionEvaluator(predictionCol="prediction", labelCol="rating", metricName="rmse")
+# MAGIC %md
+# MAGIC Fitting one model at a time leaves most of the cluster idle, because every single ALS job is small compared to the cluster. Instead we search the whole rank x regParam x maxIter grid by submitting the fits from a thread pool, so Spark runs several of them concurrently over the same cached `training_df` and `validation_df`.
+# MAGIC 
+# MAGIC The grid is searched in rounds of increasing maxIter. After each round, any (rank, regParam) pair whose RMSE is more than `tolerance` worse than the best one is dropped, so only promising configurations are trained with more iterations.
+
+# COMMAND ----------
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def fit_trial(rank, reg_param, max_iter):
+  # Passing the params to fit() trains a copy of als, so the threads never share mutable state
+  params = {als.rank: rank, als.regParam: reg_param, als.maxIter: max_iter}
+  start = time.time()
+  model = als.fit(training_df, params)
+  metrics, predict_df = evaluate_model(model, validation_df)
+  predict_df.unpersist()
+  return dict(metrics, rank=rank, regParam=reg_param, maxIter=max_iter,
+              seconds=time.time() - start, model=model)
+
+def grid_search(ranks, reg_params, max_iters, tolerance, parallelism=4):
+  survivors = [(rank, reg_param) for rank in ranks for reg_param in reg_params]
+  trials = []
+  with ThreadPoolExecutor(max_workers=parallelism) as pool:
+    for max_iter in sorted(max_iters):
+      futures = [pool.submit(fit_trial, rank, reg_param, max_iter) for (rank, reg_param) in survivors]
+      round_trials = [future.result() for future in futures]
+      trials.extend(round_trials)
+
+      # Only the running best keeps its model. Dropping the references to the others after every
+      # round lets Spark's ContextCleaner reclaim the factor RDDs that ALS persisted for them
+      best_trial = min(trials, key=lambda trial: trial['rmse'])
+      for trial in trials:
+        if trial is not best_trial:
+          trial.pop('model', None)
+
+      # Stop losing configurations early: only those close to the best RMSE get more iterations
+      min_error = min(trial['rmse'] for trial in round_trials)
+      survivors = [(trial['rank'], trial['regParam']) for trial in round_trials
+                   if trial['rmse'] <= min_error + tolerance]
+      print ('maxIter %s: %s configurations trained, %s kept' % (max_iter, len(round_trials), len(survivors)))
+
+  trials.sort(key=lambda trial: trial['rmse'])
+  return trials
+
+# COMMAND ----------
 
 tolerance = 0.03
 ranks = [4, 8, 12]
-errors = [0, 0, 0]
-models = [0, 0, 0]
-err = 0
-min_error = float('inf')
-best_rank = -1
-for rank in ranks:
-  # Set the rank here:
-  als.rank
-  # Create the model with these parameters.
-  model = als.fit(training_df)
-  # Run the model to create a prediction. Predict against the validation_df.
-  predict_df = model.transform(validation_df)
-
-  # Remove NaN values from prediction (due to SPARK-14489)
-  predicted_ratings_df = predict_df.filter(predict_df.prediction != float('nan'))
-
-  # Run the previously created RMSE evaluator, reg_eval, on the predicted_ratings_df DataFrame
-  error = reg_eval.evaluate(predicted_ratings_df)
-  errors[err] = error
-  models[err] = model
-  print ('For rank %s the RMSE is %s' % (rank, error))
-  if error < min_error:
-    min_error = error
-    best_rank = err
-  err += 1
-
-als.setRank(ranks[best_rank])
-print ('The best model was trained with rank %s' % ranks[best_rank])
-my_model = models[best_rank]
+reg_params = [0.05, 0.1, 0.2]
+max_iters = [5, 10, 20]
+
+grid_results = grid_search(ranks, reg_params, max_iters, tolerance)
+
+# A ranked results table, with all the validation metrics and the wall time of every trial
+grid_columns = ['rank', 'regParam', 'maxIter', 'rmse', 'mae', 'coverage', 'precision@10', 'recall@10', 'ndcg@10', 'map@10', 'seconds']
+grid_results_df = spark.createDataFrame(
+  [tuple(trial[column] for column in grid_columns) for trial in grid_results],
+  [column.replace('@', '_at_') for column in grid_columns])
+display(grid_results_df)
+
+best_trial = grid_results[0]
+best_rank = best_trial['rank']
+als.setRank(best_trial['rank']).setRegParam(best_trial['regParam']).setMaxIter(best_trial['maxIter'])
+print ('The best model was trained with rank %s, regParam %s and maxIter %s' % (best_trial['rank'], best_trial['regParam'], best_trial['maxIter']))
+my_model = best_trial['model']
 
 # COMMAND ----------
 
@@ -228,15 +488,22 @@ my_model = models[best_rank]
 
 # COMMAND ----------
 
-predict_df = my_model.transform(test_df)
+avg_rating_df = training_df.agg({"rating": "avg"})
+
+# Extract the average rating value. (This is row 0, column 0.)
+training_avg_rating = avg_rating_df.collect()[0][0]
+
+# One pass over test_df computes the model metrics and the average rating baseline below
+test_metrics, predict_df = evaluate_model(my_model, test_df, baseline=training_avg_rating)
 
 # Remove NaN values from prediction (due to SPARK-14489)
-predicted_test_df = predict_df.filter(predict_df.prediction != float('nan'))
+predicted_test_df = predict_df.filter(~F.isnan(predict_df.prediction))
 
-# Run the previously created RMSE evaluator, reg_eval, on the predicted_test_df DataFrame
-test_RMSE = reg_eval.evaluate(predicted_test_df )
+test_RMSE = test_metrics['rmse']
 
 print('The model had a RMSE on the test set of {0}'.format(test_RMSE))
+for metric, value in test_metrics.items():
+  print('  {0}: {1}'.format(metric, value))
 
 # COMMAND ----------
 
@@ -249,18 +516,10 @@ predicted_test_df.show()
 
 # COMMAND ----------
 
-avg_rating_df = training_df.agg({"rating": "avg"})
-
-# Extract the average rating value. (This is row 0, column 0.)
-training_avg_rating = avg_rating_df.collect()[0][0]
-
 print('The average rating for movies in the training set is {0}'.format(training_avg_rating))
 
-# Add a column with the average rating
-test_for_avg_df = test_df.withColumn('prediction', F.lit(training_avg_rating))
-
-# Run the previously created RMSE evaluator, reg_eval, on the test_for_avg_df DataFrame
-test_avg_RMSE = reg_eval.evaluate(test_for_avg_df)
+# Computed by evaluate_model in the same pass as the model metrics, with every prediction set to the average rating
+test_avg_RMSE = test_metrics['baseline_rmse']
 
 print("The RMSE on the average set is {0}".format(test_avg_RMSE))
 
@@ -269,3 +528,1060 @@ print("The RMSE on the average set is {0}".format(test_avg_RMSE))
 
 # MAGIC %md
 # MAGIC Our model is performing better than the Baseline model and we have created a Recommender system for the users :)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Scoring with `my_model.transform` joins user/movie pairs, so producing top-N lists for every user means a large Spark shuffle. The factors themselves are small, so instead we export `userFactors` and `itemFactors` once as compact float32 matrices, together with the movies every user already rated and their ratings (in CSR form: `rated_indptr`, `rated_indices`, `rated_values`). The files are plain NumPy arrays that can be memory-mapped on a single node without rebuilding the Spark session.
+
+# COMMAND ----------
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+factors_path = '/FileStore/factors'
+
+def factors_to_arrays(factors_df):
+  # One row per user (or movie), so the factors easily fit on the driver
+  pdf = factors_df.orderBy('id').toPandas()
+  ids = pdf['id'].to_numpy(dtype=np.int32)
+  factors = np.array(pdf['features'].tolist(), dtype=np.float32).reshape(len(ids), -1)
+  return ids, factors
+
+def collect_ratings(df, path, user_col='userId', item_col='movieId', rating_col='rating'):
+  # Go through Parquet rather than collect(), so 20M ratings never become Python Row objects
+  df.select(user_col, item_col, rating_col).write.mode('overwrite').parquet(path)
+  pdf = pd.read_parquet('/dbfs' + path)
+  return (pdf[user_col].to_numpy(dtype=np.int32), pdf[item_col].to_numpy(dtype=np.int32),
+          pdf[rating_col].to_numpy(dtype=np.float32))
+
+def rated_to_csr(ratings_df, user_ids, item_ids, path):
+  users, items, values = collect_ratings(ratings_df, path + '/rated')
+
+  # Map ids to factor rows, keeping only pairs where both the user and the movie have factors
+  rows = np.minimum(np.searchsorted(user_ids, users), len(user_ids) - 1)
+  cols = np.minimum(np.searchsorted(item_ids, items), len(item_ids) - 1)
+  known = (user_ids[rows] == users) & (item_ids[cols] == items)
+  rows, cols, values = rows[known], cols[known], values[known]
+
+  order = np.lexsort((cols, rows))
+  rated_indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=rated_indptr[1:])
+  return rated_indptr, cols[order].astype(np.int32), values[order]
+
+def save_factors(factors, path):
+  local_path = '/dbfs' + path
+  os.makedirs(local_path, exist_ok=True)
+  for name, array in factors.items():
+    np.save('%s/%s.npy' % (local_path, name), array)
+
+  # The manifest is written last, so a reader never sees a half written set of factors,
+  # and it is swapped in with os.replace, so a reader never sees a half written manifest
+  manifest = {'version': time.time(), 'rank': int(factors['user_factors'].shape[1]),
+              'users': len(factors['user_ids']), 'movies': len(factors['item_ids'])}
+  with open(local_path + '/manifest.json.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.replace(local_path + '/manifest.json.tmp', local_path + '/manifest.json')
+  return manifest
+
+def export_factors(model, ratings_df, path):
+  user_ids, user_factors = factors_to_arrays(model.userFactors)
+  item_ids, item_factors = factors_to_arrays(model.itemFactors)
+  rated_indptr, rated_indices, rated_values = rated_to_csr(ratings_df, user_ids, item_ids, path)
+  return save_factors({'user_ids': user_ids, 'user_factors': user_factors,
+                       'item_ids': item_ids, 'item_factors': item_factors,
+                       'rated_indptr': rated_indptr, 'rated_indices': rated_indices,
+                       'rated_values': rated_values}, path)
+
+def load_factors(path):
+  local_path = '/dbfs' + path
+  names = ['user_ids', 'user_factors', 'item_ids', 'item_factors', 'rated_indptr', 'rated_indices', 'rated_values']
+  factors = {name: np.load('%s/%s.npy' % (local_path, name), mmap_mode='r') for name in names}
+  with open(local_path + '/manifest.json') as f:
+    factors['manifest'] = json.load(f)
+  return factors
+
+manifest = export_factors(my_model, ratings_df, factors_path)
+print ('Exported rank %s factors for %s users and %s movies' % (manifest['rank'], manifest['users'], manifest['movies']))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC With the factors on local disk, top-K recommendations are a blocked matrix multiply: a block of users is scored against every movie at once, the movies a user already rated are masked out, and `np.argpartition` picks the K best without sorting the whole catalog. NumPy releases the GIL inside the multiply, so the blocks run in parallel on a thread pool. The block size follows from `block_memory` and the pool is capped at 8 threads by default, so the memory used stays bounded on large drivers.
+
+# COMMAND ----------
+
+def top_k(queries, item_factors, k, exclude_indptr=None, exclude_indices=None):
+  scores = queries @ item_factors.T
+
+  # Exclude movies the users already rated (exclude_indptr may be a slice of a larger CSR)
+  if exclude_indptr is not None:
+    rows = np.repeat(np.arange(len(queries)), np.diff(exclude_indptr))
+    scores[rows, exclude_indices[exclude_indptr[0]:exclude_indptr[-1]]] = -np.inf
+
+  # Negated in place rather than copied, so argpartition can pick the smallest without a second score matrix
+  np.negative(scores, out=scores)
+  k = min(k, scores.shape[1])
+  top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+  top_scores = np.take_along_axis(scores, top, axis=1)
+  order = np.argsort(top_scores, axis=1)
+  return np.take_along_axis(top, order, axis=1), -np.take_along_axis(top_scores, order, axis=1)
+
+def recommend_all(factors, k=10, block_memory=256 * 1024 * 1024, workers=min(8, os.cpu_count())):
+  user_factors = factors['user_factors']
+  item_factors = np.ascontiguousarray(factors['item_factors'])
+  rated_indptr, rated_indices = factors['rated_indptr'], factors['rated_indices']
+  n_users = len(user_factors)
+  k = min(k, len(item_factors))
+
+  # Every user in a block costs a float32 score and an int64 argpartition index per movie,
+  # so the driver needs about workers * block_memory (plus the threads BLAS starts itself)
+  block_size = max(1, block_memory // (12 * len(item_factors)))
+
+  top_items = np.empty((n_users, k), dtype=np.int32)
+  top_scores = np.empty((n_users, k), dtype=np.float32)
+
+  def recommend_block(start):
+    end = min(start + block_size, n_users)
+    index, scores = top_k(np.asarray(user_factors[start:end]), item_factors, k,
+                          rated_indptr[start:end + 1], rated_indices)
+    top_items[start:end] = factors['item_ids'][index]
+    top_scores[start:end] = scores
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    list(pool.map(recommend_block, range(0, n_users, block_size)))
+  return top_items, top_scores
+
+factors = load_factors(factors_path)
+
+start = time.time()
+top_items, top_scores = recommend_all(factors, k=10)
+print ('Top 10 movies for %s users computed in %.1f seconds' % (len(top_items), time.time() - start))
+
+np.save('/dbfs%s/recommended_items.npy' % factors_path, top_items)
+np.save('/dbfs%s/recommended_scores.npy' % factors_path, top_scores)
+
+movie_titles = dict(movies_df.select('ID', 'title').collect())
+print ('Recommendations for user %s:' % factors['user_ids'][0])
+for movie_id, score in zip(top_items[0], top_scores[0]):
+  print ('%.3f  %s' % (score, movie_titles.get(int(movie_id))))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Answering "movies like Toy Story (1995)", or a single user's top-K, should not require scoring the whole catalog. We build an approximate nearest-neighbour index over the item factors: an inverted-file (IVF) index, where the movies are clustered with spherical k-means and a query only scores the movies in the `nprobe` clusters closest to it.
+# MAGIC 
+# MAGIC The same index answers two kinds of queries:
+# MAGIC 
+# MAGIC - `metric='cosine'` for "similar movies": the factors are normalized, so the index ranks by cosine similarity.
+# MAGIC - `metric='ip'` for maximum inner product (a user's predicted ratings): every movie gets one extra coordinate `sqrt(M^2 - |x|^2)`, where M is the largest factor norm, so all movies have the same norm and the closest clusters by angle are also the ones with the largest inner products.
+
+# COMMAND ----------
+
+def spherical_kmeans(points, n_lists, n_iter=10, seed=0):
+  rng = np.random.default_rng(seed)
+  centroids = points[rng.choice(len(points), n_lists, replace=False)]
+  for i in range(n_iter):
+    assignment = np.argmax(points @ centroids.T, axis=1)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignment, points)
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    # Empty clusters keep their previous centroid
+    centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+  return centroids, np.argmax(points @ centroids.T, axis=1)
+
+class IVFIndex:
+
+  def __init__(self, movie_ids, titles, vectors, centroids, list_offsets, metric):
+    # Movies are stored grouped by cluster: cluster c owns rows list_offsets[c]:list_offsets[c + 1]
+    self.movie_ids = movie_ids
+    self.titles = titles
+    self.vectors = vectors
+    self.centroids = centroids
+    self.list_offsets = list_offsets
+    self.metric = metric
+    self.id_order = np.argsort(movie_ids)
+
+  @classmethod
+  def build(cls, movie_ids, vectors, movie_titles, metric='ip', n_lists=None, n_iter=10, seed=0):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    if metric == 'cosine':
+      vectors = vectors / np.maximum(norms, 1e-12)[:, None]
+      keys = vectors
+    elif metric == 'ip':
+      max_norm = norms.max()
+      extra = np.sqrt(np.maximum(max_norm ** 2 - norms ** 2, 0))
+      keys = np.hstack([vectors, extra[:, None]]) / max_norm
+    else:
+      raise ValueError('Unknown metric %s' % metric)
+
+    n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+    centroids, assignment = spherical_kmeans(keys, n_lists, n_iter, seed)
+    order = np.argsort(assignment, kind='stable')
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+
+    movie_ids = np.asarray(movie_ids, dtype=np.int32)[order]
+    titles = np.array([movie_titles.get(int(movie_id), '') for movie_id in movie_ids])
+    return cls(movie_ids, titles, vectors[order], centroids.astype(np.float32), list_offsets, metric)
+
+  def query_key(self, query):
+    query = np.asarray(query, dtype=np.float32)
+    query = query / max(np.linalg.norm(query), 1e-12)
+    return query if self.metric == 'cosine' else np.append(query, np.float32(0))
+
+  def positions(self, movie_ids):
+    # Rows of the given movies in the index, skipping movies the index does not know
+    movie_ids = np.asarray(movie_ids, dtype=np.int32)
+    found = np.minimum(np.searchsorted(self.movie_ids[self.id_order], movie_ids), len(self.movie_ids) - 1)
+    rows = self.id_order[found]
+    return rows[self.movie_ids[rows] == movie_ids]
+
+  def rank(self, candidates, query, k, exclude):
+    query = np.asarray(query, dtype=np.float32)
+    if self.metric == 'cosine':
+      query = query / max(np.linalg.norm(query), 1e-12)
+    scores = self.vectors[candidates] @ query
+    if exclude is not None:
+      scores[np.isin(candidates, self.positions(exclude))] = -np.inf
+    k = min(k, len(candidates))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return self.movie_ids[candidates[top]], scores[top]
+
+  def search(self, query, k=10, nprobe=8, exclude=None):
+    probe = np.argsort(-(self.centroids @ self.query_key(query)))[:nprobe]
+    candidates = np.concatenate([np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in probe])
+    return self.rank(candidates, query, k, exclude)
+
+  def search_exact(self, query, k=10, exclude=None):
+    return self.rank(np.arange(len(self.movie_ids)), query, k, exclude)
+
+  def similar_movies(self, movie_id, k=10, nprobe=8):
+    # movie_id() gives None for an unknown title, which is treated like an unknown id
+    if movie_id is None:
+      return []
+    row = self.positions([movie_id])
+    if len(row) == 0:
+      return []
+    movie_ids, scores = self.search(self.vectors[row[0]], k, nprobe, exclude=[movie_id])
+    return [(int(m), str(self.titles[r]), float(s)) for m, r, s in zip(movie_ids, self.positions(movie_ids), scores)]
+
+  def movie_id(self, title):
+    matches = np.flatnonzero(self.titles == title)
+    return int(self.movie_ids[matches[0]]) if len(matches) else None
+
+  def save(self, path):
+    np.savez('/dbfs' + path, movie_ids=self.movie_ids, titles=self.titles, vectors=self.vectors,
+             centroids=self.centroids, list_offsets=self.list_offsets, metric=np.array(self.metric))
+
+  @classmethod
+  def load(cls, path):
+    data = np.load('/dbfs' + path)
+    return cls(data['movie_ids'], data['titles'], data['vectors'], data['centroids'],
+               data['list_offsets'], str(data['metric']))
+
+# COMMAND ----------
+
+similar_index = IVFIndex.build(factors['item_ids'], factors['item_factors'], movie_titles, metric='cosine')
+mips_index = IVFIndex.build(factors['item_ids'], factors['item_factors'], movie_titles, metric='ip')
+similar_index.save(factors_path + '/similar_index.npz')
+mips_index.save(factors_path + '/mips_index.npz')
+
+similar_index = IVFIndex.load(factors_path + '/similar_index.npz')
+mips_index = IVFIndex.load(factors_path + '/mips_index.npz')
+
+print ('Movies like Toy Story (1995):')
+for movie_id, title, score in similar_index.similar_movies(similar_index.movie_id('Toy Story (1995)')):
+  print ('%.3f  %s' % (score, title))
+
+# A single user's top 10, skipping the movies they already rated
+user_row = 0
+rated = factors['item_ids'][factors['rated_indices'][factors['rated_indptr'][user_row]:factors['rated_indptr'][user_row + 1]]]
+movie_ids, scores = mips_index.search(factors['user_factors'][user_row], k=10, exclude=rated)
+print ('Top 10 for user %s:' % factors['user_ids'][user_row])
+for movie_id, score in zip(movie_ids, scores):
+  print ('%.3f  %s' % (score, movie_titles.get(int(movie_id))))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The index trades recall for latency through `nprobe`. To tune it, we compare each setting against exact brute-force scoring on a sample of queries and report recall@K next to the mean, p50 and p99 latency per query.
+
+# COMMAND ----------
+
+def benchmark_index(index, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+  def timed(search):
+    latencies, results = [], []
+    for query in queries:
+      start = time.perf_counter()
+      results.append(search(query)[0])
+      latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+  exact, latencies = timed(lambda query: index.search_exact(query, k))
+  rows = [('exact', 1.0, float(latencies.mean()), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99)))]
+  for nprobe in nprobes:
+    approx, latencies = timed(lambda query: index.search(query, k, nprobe))
+    recall = np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(approx, exact)])
+    rows.append((str(nprobe), float(recall), float(latencies.mean()), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))))
+  return spark.createDataFrame(rows, ['nprobe', 'recall', 'mean_ms', 'p50_ms', 'p99_ms'])
+
+rng = np.random.default_rng(0)
+user_queries = np.asarray(factors['user_factors'])[rng.choice(len(factors['user_factors']), 1000, replace=False)]
+movie_queries = similar_index.vectors[rng.choice(len(similar_index.vectors), 1000, replace=False)]
+
+print ('Maximum inner product (user top-K):')
+display(benchmark_index(mips_index, user_queries))
+print ('Cosine (similar movies):')
+display(benchmark_index(similar_index, movie_queries))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC A new user gets NaN from `model.transform`, and retraining ALS on 20M ratings for every signup is far too slow. Because ALS alternates between two least squares problems, we can "fold in" a user without retraining: keep the trained item factors Y fixed and solve the same regularized problem ALS solves for one user,
+# MAGIC 
+# MAGIC `x_u = (Y_u^T Y_u + regParam * n_u * I)^-1 Y_u^T r_u`
+# MAGIC 
+# MAGIC where Y_u are the factors of the n_u movies the user rated and r_u their ratings (Spark scales regParam by n_u in the same way). This is a rank x rank solve, so it takes well under a millisecond. Users without any usable history fall back to the popularity ranking.
+
+# COMMAND ----------
+
+def fold_in(item_factors, item_rows, ratings, reg_param):
+  item_vectors = np.asarray(item_factors[item_rows], dtype=np.float32)
+  A = item_vectors.T @ item_vectors + reg_param * len(item_rows) * np.eye(item_vectors.shape[1], dtype=np.float32)
+  return np.linalg.solve(A, item_vectors.T @ np.asarray(ratings, dtype=np.float32)).astype(np.float32)
+
+class FoldInUsers:
+
+  def __init__(self, factors, reg_param, popular_movie_ids):
+    self.factors = factors
+    self.reg_param = reg_param
+    self.popular_movie_ids = list(popular_movie_ids)
+    self.item_factors = np.ascontiguousarray(factors['item_factors'])
+    # Users updated since the factors were exported: user id -> (item rows, ratings, vector)
+    self.updated = {}
+
+  def trained_row(self, user_id):
+    user_ids = self.factors['user_ids']
+    row = np.searchsorted(user_ids, user_id)
+    return row if row < len(user_ids) and user_ids[row] == user_id else None
+
+  def history(self, user_id):
+    if user_id in self.updated:
+      return self.updated[user_id][:2]
+    row = self.trained_row(user_id)
+    if row is None:
+      return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    start, end = self.factors['rated_indptr'][row], self.factors['rated_indptr'][row + 1]
+    return np.asarray(self.factors['rated_indices'][start:end]), np.asarray(self.factors['rated_values'][start:end])
+
+  def vector(self, user_id):
+    if user_id in self.updated:
+      return self.updated[user_id][2]
+    row = self.trained_row(user_id)
+    return None if row is None else np.asarray(self.factors['user_factors'][row])
+
+  def apply_ratings(self, batch):
+    # batch is an iterable of (userId, movieId, rating); a new rating of a movie replaces the old one
+    item_ids = self.factors['item_ids']
+    by_user = {}
+    for user_id, movie_id, rating in batch:
+      item_row = np.searchsorted(item_ids, movie_id)
+      # Movies that have no factors yet cannot contribute to the fold-in
+      if item_row < len(item_ids) and item_ids[item_row] == movie_id:
+        by_user.setdefault(user_id, {})[int(item_row)] = rating
+
+    for user_id, new_ratings in by_user.items():
+      item_rows, ratings = self.history(user_id)
+      merged = dict(zip(item_rows.tolist(), ratings.tolist()))
+      merged.update(new_ratings)
+      item_rows = np.fromiter(merged.keys(), dtype=np.int32, count=len(merged))
+      ratings = np.fromiter(merged.values(), dtype=np.float32, count=len(merged))
+      self.updated[user_id] = (item_rows, ratings, fold_in(self.item_factors, item_rows, ratings, self.reg_param))
+    return list(by_user)
+
+  def recommend(self, user_id, k=10):
+    item_rows, ratings = self.history(user_id)
+    vector = self.vector(user_id)
+    if vector is None:
+      rated = set(self.factors['item_ids'][item_rows].tolist())
+      return [movie_id for movie_id in self.popular_movie_ids if movie_id not in rated][:k]
+    index, scores = top_k(vector[None, :], self.item_factors, k, np.array([0, len(item_rows)]), item_rows)
+    return self.factors['item_ids'][index[0]].tolist()
+
+# COMMAND ----------
+
+popular_movie_ids = [movie['movieId'] for movie in popular_movies(100)]
+fold_in_users = FoldInUsers(factors, als.getRegParam(), popular_movie_ids)
+
+# A brand new user with no ratings gets the popularity ranking
+new_user_id = int(factors['user_ids'][-1]) + 1
+print ('Recommendations for a user without ratings:')
+for movie_id in fold_in_users.recommend(new_user_id):
+  print (movie_titles.get(movie_id))
+
+# After a small batch of ratings, the user is folded in against the fixed item factors
+toy_story_id = similar_index.movie_id('Toy Story (1995)')
+new_ratings = [(new_user_id, toy_story_id, 5.0)] + [(new_user_id, movie_id, 4.5) for movie_id, title, score in similar_index.similar_movies(toy_story_id, k=4)]
+start = time.perf_counter()
+fold_in_users.apply_ratings(new_ratings)
+print ('Folded in user %s in %.2f ms' % (new_user_id, (time.perf_counter() - start) * 1000))
+
+print ('Recommendations after the new ratings:')
+for movie_id in fold_in_users.recommend(new_user_id):
+  print (movie_titles.get(movie_id))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC MovieLens-20M fits comfortably in the memory of a single machine, so starting a Spark cluster just to run `als.fit(training_df)` mostly pays for JVM startup and shuffles. `LocalALS` is an in-process ALS trainer with the same parameters as `als` (rank, regParam, maxIter, userCol, itemCol, ratingCol). The ratings are held as a CSR matrix (rows are users) and a CSC matrix (columns are movies). Each half-iteration solves the normal equations for a block of users (or movies) at once: the Gram matrices of the block are summed with `np.add.reduceat`, and all of them are solved in one batched `np.linalg.solve`. The blocks run on a thread pool.
+# MAGIC 
+# MAGIC `LocalALSModel` exposes `userFactors`, `itemFactors` and `transform()` like the Spark `ALSModel`, so it plugs into `evaluate_model`, `export_factors` and the top-K code above unchanged.
+
+# COMMAND ----------
+
+import scipy.sparse as sp
+
+class LocalALSModel:
+
+  def __init__(self, user_ids, user_factors, item_ids, item_factors, user_col='userId', item_col='movieId'):
+    self.user_ids = user_ids
+    self.user_factors = user_factors
+    self.item_ids = item_ids
+    self.item_factors = item_factors
+    self.user_col = user_col
+    self.item_col = item_col
+
+  @staticmethod
+  def factors_df(ids, factors):
+    return spark.createDataFrame(pd.DataFrame({'id': ids, 'features': factors.tolist()}), 'id int, features array<float>')
+
+  @property
+  def userFactors(self):
+    return self.factors_df(self.user_ids, self.user_factors)
+
+  @property
+  def itemFactors(self):
+    return self.factors_df(self.item_ids, self.item_factors)
+
+  def transform(self, df):
+    user_df = self.userFactors.select(F.col('id').alias(self.user_col), F.col('features').alias('user_features'))
+    item_df = self.itemFactors.select(F.col('id').alias(self.item_col), F.col('features').alias('item_features'))
+    prediction = F.expr('aggregate(zip_with(user_features, item_features, (x, y) -> x * y), CAST(0 AS FLOAT), (acc, v) -> acc + v)')
+    # Like ALSModel, unknown users and movies get a NaN prediction
+    return df.join(user_df, self.user_col, 'left').join(item_df, self.item_col, 'left')\
+             .withColumn('prediction', F.coalesce(prediction, F.lit(float('nan')).cast('float')))\
+             .drop('user_features', 'item_features')
+
+class LocalALS:
+
+  def __init__(self, rank=10, regParam=0.1, maxIter=10, userCol='userId', itemCol='movieId', ratingCol='rating',
+               seed=0, block_memory=64 * 1024 * 1024, workers=os.cpu_count()):
+    self.rank = rank
+    self.regParam = regParam
+    self.maxIter = maxIter
+    self.userCol = userCol
+    self.itemCol = itemCol
+    self.ratingCol = ratingCol
+    self.seed = seed
+    self.block_memory = block_memory
+    self.workers = workers
+
+  def init_factors(self, rng, n):
+    # Same initialization as Spark: random Gaussian rows scaled to unit length
+    factors = rng.standard_normal((n, self.rank)).astype(np.float32)
+    return factors / np.linalg.norm(factors, axis=1, keepdims=True)
+
+  def solve_block(self, indptr, indices, data, fixed, out, start, end):
+    lo, hi = indptr[start], indptr[end]
+    counts = np.diff(indptr[start:end + 1])
+    rated = counts > 0
+    segments = (indptr[start:end] - lo)[rated]
+    fixed_rows = fixed[indices[lo:hi]]
+
+    gram = np.zeros((end - start, self.rank, self.rank), dtype=np.float32)
+    rhs = np.zeros((end - start, self.rank), dtype=np.float32)
+    gram[rated] = np.add.reduceat(np.einsum('ni,nj->nij', fixed_rows, fixed_rows), segments, axis=0)
+    rhs[rated] = np.add.reduceat(fixed_rows * data[lo:hi, None], segments, axis=0)
+
+    # Spark scales regParam by the number of ratings; rows without ratings get a zero vector
+    gram += (self.regParam * counts + ~rated)[:, None, None] * np.eye(self.rank, dtype=np.float32)
+    out[start:end] = np.linalg.solve(gram, rhs[..., None])[..., 0]
+
+  def solve_all(self, matrix, fixed, pool):
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    n = len(indptr) - 1
+    out = np.empty((n, self.rank), dtype=np.float32)
+
+    # Cut the rows into blocks whose rank x rank outer products fit in block_memory
+    max_nnz = max(1, self.block_memory // (4 * self.rank * self.rank))
+    cuts = np.searchsorted(indptr, np.arange(max_nnz, indptr[-1], max_nnz), side='right') - 1
+    bounds = np.unique(np.concatenate([[0], cuts, [n]]))
+    list(pool.map(lambda block: self.solve_block(indptr, indices, data, fixed, out, *block), zip(bounds[:-1], bounds[1:])))
+    return out
+
+  def fit_arrays(self, users, items, ratings):
+    user_ids, user_rows = np.unique(users, return_inverse=True)
+    item_ids, item_rows = np.unique(items, return_inverse=True)
+    by_user = sp.csr_matrix((ratings, (user_rows, item_rows)), shape=(len(user_ids), len(item_ids)), dtype=np.float32)
+    by_item = by_user.tocsc()
+
+    rng = np.random.default_rng(self.seed)
+    user_factors = self.init_factors(rng, len(user_ids))
+    item_factors = self.init_factors(rng, len(item_ids))
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      for i in range(self.maxIter):
+        # Spark updates the item factors first, then the user factors
+        item_factors = self.solve_all(by_item, user_factors, pool)
+        user_factors = self.solve_all(by_user, item_factors, pool)
+    return LocalALSModel(user_ids.astype(np.int32), user_factors, item_ids.astype(np.int32), item_factors,
+                         self.userCol, self.itemCol)
+
+  def fit(self, df, path='/FileStore/local_als/training'):
+    return self.fit_arrays(*collect_ratings(df, path, self.userCol, self.itemCol, self.ratingCol))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC To compare the two engines, we train both with the parameters of the best grid search trial on the same `training_df` and evaluate both on `validation_df` with `evaluate_model`. For the local trainer, peak memory is the peak NumPy allocation traced by `tracemalloc`. For Spark, the fit runs in its own job group and we report the `peakExecutionMemory` of its largest stage from the Spark status API: the summed peak execution memory (shuffle, join and aggregation buffers) of that stage's tasks. It does not include cached blocks or JVM overhead, so it is the closest Spark counterpart to the NumPy peak, not a process RSS.
+
+# COMMAND ----------
+
+import tracemalloc
+import urllib.request
+
+def spark_status(endpoint):
+  sc = spark.sparkContext
+  with urllib.request.urlopen('%s/api/v1/applications/%s/%s' % (sc.uiWebUrl, sc.applicationId, endpoint)) as response:
+    return json.load(response)
+
+def stage_metrics(job_group):
+  # The status store is filled by a listener asynchronously, so wait until it has seen every stage finish
+  for attempt in range(20):
+    stage_ids = {stage_id for job in spark_status('jobs') if job.get('jobGroup') == job_group for stage_id in job['stageIds']}
+    stages = [stage for stage in spark_status('stages') if stage['stageId'] in stage_ids]
+    if all(stage['status'] in ('COMPLETE', 'SKIPPED', 'FAILED') for stage in stages):
+      break
+    time.sleep(0.5)
+
+  metrics = {'jobs': len([job for job in spark_status('jobs') if job.get('jobGroup') == job_group]),
+             'stages': len([stage for stage in stages if stage['status'] != 'SKIPPED']),
+             'tasks': sum(stage['numCompleteTasks'] for stage in stages)}
+  for name in ['executorRunTime', 'executorCpuTime', 'inputBytes', 'shuffleReadBytes', 'shuffleWriteBytes',
+               'memoryBytesSpilled', 'diskBytesSpilled']:
+    metrics[name] = sum(stage.get(name, 0) for stage in stages)
+  # peakExecutionMemory of a stage is the sum of its tasks' peaks; report the largest stage
+  metrics['peakExecutionMemory'] = max([stage.get('peakExecutionMemory', 0) for stage in stages] or [0])
+  return metrics
+
+spark_fit_group = 'als-comparison-%d' % time.time()
+spark.sparkContext.setJobGroup(spark_fit_group, 'Spark ALS fit for the engine comparison')
+start = time.time()
+try:
+  spark_model = als.fit(training_df)
+finally:
+  spark_seconds = time.time() - start
+  spark.sparkContext.setLocalProperty('spark.jobGroup.id', None)
+spark_fit_metrics = stage_metrics(spark_fit_group)
+spark_metrics, spark_predict_df = evaluate_model(spark_model, validation_df)
+spark_predict_df.unpersist()
+
+local_als = LocalALS(rank=als.getRank(), regParam=als.getRegParam(), maxIter=als.getMaxIter())
+start = time.time()
+training_arrays = collect_ratings(training_df, '/FileStore/local_als/training')
+collect_seconds = time.time() - start
+
+tracemalloc.start()
+start = time.time()
+local_model = local_als.fit_arrays(*training_arrays)
+local_seconds = time.time() - start
+local_peak_memory = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+local_metrics, local_predict_df = evaluate_model(local_model, validation_df)
+local_predict_df.unpersist()
+
+print ('Collecting the training ratings for the local trainer took %.1f seconds' % collect_seconds)
+display(spark.createDataFrame(
+  [('spark', spark_seconds, 'stage peak execution memory', spark_fit_metrics['peakExecutionMemory'] / 2 ** 20,
+    spark_metrics['rmse'], spark_metrics['ndcg@10']),
+   ('local', local_seconds, 'tracemalloc peak', local_peak_memory / 2 ** 20, local_metrics['rmse'], local_metrics['ndcg@10'])],
+  ['engine', 'seconds', 'memory_measure', 'peak_memory_mb', 'rmse', 'ndcg_at_10']))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Everything above runs on one dataset, so we have no repeatable way to see how loading, aggregation, `randomSplit`, the ALS fit, `transform` and evaluation scale with the data or the cluster. The benchmark below generates synthetic MovieLens-shaped ratings with Spark, so it needs no network and runs from 1M to 200M rows:
+# MAGIC 
+# MAGIC - user and movie ids are ranks drawn from truncated Zipf laws, `P(id) ~ (id + offset)^-exponent` for ids 1 to n. The exponents and offsets are fitted to the rating counts in MovieLens-20M: the most rated movie gets about 0.34% of the ratings and the median movie 18, and the most active user about 0.046% and the median user about 65, with a long tail of movies that have only a handful of ratings. By default there are about 145 ratings per user and 730 per movie, the MovieLens-20M averages.
+# MAGIC - users and movies are drawn independently, so popular users often draw the same popular movie twice. Repeated (user, movie) pairs are dropped, as MovieLens has one rating per pair. Between 17% and 27% of the draws are repeats (more with more data), so we draw 30% more rows than asked for. The row count actually written is recorded with the run.
+# MAGIC - ratings are `3.5 + user bias + movie bias + noise`, rounded to half stars and clipped to 0.5 - 5.0.
+# MAGIC 
+# MAGIC Every stage runs in its own Spark job group. After the stage, its jobs and stages are looked up in the Spark status API (the same metrics the Spark UI shows) to collect task time, shuffle bytes and spill. Each run is written as JSON with the cluster size, so runs can be compared across data sizes, code changes and clusters.
+
+# COMMAND ----------
+
+import uuid
+
+benchmark_path = '/FileStore/benchmarks'
+
+def zipf_id(n, exponent, offset, seed):
+  # Inverse CDF of (id + offset)^-exponent over ids 1 to n (exponent != 1)
+  power = 1.0 - exponent
+  low, high = (1 + offset) ** power, (n + 1 + offset) ** power
+  rank = F.floor(F.pow(low + F.rand(seed) * (high - low), 1.0 / power) - offset)
+  return F.least(rank, F.lit(n)).cast('int')
+
+# Fitted to the rating counts per user and per movie in MovieLens-20M
+def synthetic_ratings(n_ratings, n_users=None, n_movies=None, user_exponent=0.85, user_offset=200,
+                      movie_exponent=2.3, movie_offset=400, oversample=1.3, seed=0):
+  n_users = n_users or max(1, n_ratings // 145)
+  n_movies = n_movies or max(1, n_ratings // 730)
+
+  def bias(id_col, salt, scale):
+    # A fixed pseudo-random bias per id, in [-scale / 2, scale / 2)
+    return (F.abs(F.hash(id_col, F.lit(seed + salt))) % 1000 / 1000 - 0.5) * scale
+
+  ids_df = (spark.range(int(n_ratings * oversample))
+    .select(zipf_id(n_users, user_exponent, user_offset, seed).alias('userId'),
+            zipf_id(n_movies, movie_exponent, movie_offset, seed + 1).alias('movieId'))
+    .dropDuplicates(['userId', 'movieId']))
+  rating = 3.5 + bias('userId', 2, 1.0) + bias('movieId', 3, 2.0) + F.randn(seed + 4) * 0.8
+  return ids_df.withColumn('rating', F.least(F.greatest(F.round(rating * 2) / 2, F.lit(0.5)), F.lit(5.0)).cast('float'))
+
+def run_stage(run, name, action):
+  sc = spark.sparkContext
+  job_group = '%s:%s' % (run['run_id'], name)
+  sc.setJobGroup(job_group, 'benchmark stage %s' % name)
+  start = time.time()
+  try:
+    value = action()
+  finally:
+    seconds = time.time() - start
+    sc.setLocalProperty('spark.jobGroup.id', None)
+  run['stages'].append(dict(stage_metrics(job_group), stage=name, seconds=seconds))
+  print ('%-10s %8.1f seconds' % (name, seconds))
+  return value
+
+def run_benchmark(n_ratings, rank=10, reg_param=0.1, max_iter=5, seed=0):
+  sc = spark.sparkContext
+  run = {'run_id': uuid.uuid4().hex[:12], 'started_at': time.time(), 'n_ratings': n_ratings,
+         'params': {'rank': rank, 'regParam': reg_param, 'maxIter': max_iter, 'seed': seed},
+         'cluster': {'spark_version': spark.version, 'default_parallelism': sc.defaultParallelism,
+                     'executors': len([e for e in spark_status('executors') if e['id'] != 'driver'])},
+         'stages': []}
+  data_path = '%s/data/%s' % (benchmark_path, n_ratings)
+
+  run_stage(run, 'generate', lambda: synthetic_ratings(n_ratings, seed=seed).write.mode('overwrite').parquet(data_path))
+  bench_ratings_df = spark.read.parquet(data_path)
+  run['rows'] = run_stage(run, 'load', lambda: bench_ratings_df.count())
+  run_stage(run, 'aggregate', lambda: aggregate_ratings(bench_ratings_df).write.format('noop').mode('overwrite').save())
+
+  def split():
+    splits = [df.cache() for df in bench_ratings_df.randomSplit([0.6, 0.2, 0.2], seed)]
+    for df in splits:
+      df.count()
+    return splits
+  bench_training_df, bench_validation_df, bench_test_df = run_stage(run, 'split', split)
+
+  bench_als = ALS(rank=rank, regParam=reg_param, maxIter=max_iter, userCol='userId', itemCol='movieId', ratingCol='rating', seed=seed)
+  bench_model = run_stage(run, 'fit', lambda: bench_als.fit(bench_training_df))
+  run_stage(run, 'transform', lambda: bench_model.transform(bench_validation_df).write.format('noop').mode('overwrite').save())
+  bench_metrics, bench_predict_df = run_stage(run, 'evaluate', lambda: evaluate_model(bench_model, bench_validation_df))
+  run['metrics'] = bench_metrics
+
+  for df in [bench_predict_df, bench_training_df, bench_validation_df, bench_test_df]:
+    df.unpersist()
+
+  results_path = '/dbfs%s/results' % benchmark_path
+  os.makedirs(results_path, exist_ok=True)
+  with open('%s/%s.json' % (results_path, run['run_id']), 'w') as f:
+    json.dump(run, f, indent=2)
+  return run
+
+def load_benchmark_results():
+  # One row per run and stage, to compare runs across data sizes and clusters
+  results_path = '/dbfs%s/results' % benchmark_path
+  rows = []
+  for file_name in sorted(os.listdir(results_path)):
+    with open('%s/%s' % (results_path, file_name)) as f:
+      run = json.load(f)
+    for step, stage in enumerate(run['stages']):
+      rows.append(dict(stage, step=step, run_id=run['run_id'], started_at=run['started_at'], n_ratings=run['n_ratings'],
+                       rows=run.get('rows'), executors=run['cluster']['executors']))
+  return spark.createDataFrame(pd.DataFrame(rows))
+
+# COMMAND ----------
+
+# Add 50000000, 100000000 and 200000000 for a full scaling run on a large cluster
+for n_ratings in [1000000, 10000000]:
+  print ('Benchmark with %s ratings:' % n_ratings)
+  run_benchmark(n_ratings)
+
+display(load_benchmark_results().orderBy('started_at', 'step'))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The only way to get a recommendation so far is to run the cells above. `RecommendationService` is a small asyncio HTTP service that answers from the exported factors, without Spark:
+# MAGIC 
+# MAGIC - `GET /recommend?user=<userId>&n=<n>` returns the user's top-N movies, excluding movies they already rated. Unknown users get the precomputed popularity top-N.
+# MAGIC - `GET /similar?movie=<movieId>&n=<n>` returns the N movies with the most similar factors (cosine).
+# MAGIC - `GET /metrics` returns a latency histogram per endpoint, cache hit rates and micro-batch sizes.
+# MAGIC 
+# MAGIC Concurrent requests are queued and scored together: a micro-batch is closed after `max_batch` requests or `max_wait_ms`, whichever comes first, and is scored with one matrix multiply on a worker thread, so the event loop keeps accepting requests. Results are kept in a size-bounded LRU cache with a TTL. The service polls `manifest.json`, which `save_factors` writes last. When new factors are published, it reloads them and clears the cache.
+
+# COMMAND ----------
+
+import asyncio
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+def save_movie_titles(movies_df, path):
+  with open('/dbfs%s/movie_titles.json' % path, 'w') as f:
+    json.dump({str(movie_id): title for movie_id, title in movies_df.select('ID', 'title').collect()}, f)
+
+class ResultCache:
+
+  def __init__(self, max_size=100000, ttl_seconds=300):
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None or entry[0] < time.monotonic():
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return entry[1]
+
+  def put(self, key, value):
+    self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+
+class LatencyHistogram:
+
+  bounds_ms = [0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000, float('inf')]
+
+  def __init__(self):
+    self.counts = [0] * len(self.bounds_ms)
+
+  def observe(self, ms):
+    self.counts[next(i for i, bound in enumerate(self.bounds_ms) if ms <= bound)] += 1
+
+  def percentile(self, p):
+    # The upper bound of the bucket holding the p-th percentile
+    target = sum(self.counts) * p / 100
+    seen = 0
+    for bound, count in zip(self.bounds_ms, self.counts):
+      seen += count
+      if count and seen >= target:
+        return bound
+    return None
+
+  def snapshot(self):
+    return {'count': sum(self.counts), 'p50_ms': self.percentile(50), 'p99_ms': self.percentile(99),
+            'buckets': {str(bound): count for bound, count in zip(self.bounds_ms, self.counts)}}
+
+class MicroBatcher:
+
+  def __init__(self, score_batch, max_batch=64, max_wait_ms=2):
+    self.score_batch = score_batch
+    self.max_batch = max_batch
+    self.max_wait_ms = max_wait_ms
+    # Created in run(), so the queue belongs to the service's event loop
+    self.queue = None
+    self.batches = 0
+    self.batched_requests = 0
+
+  async def submit(self, request):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((request, future))
+    return await future
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    self.queue = asyncio.Queue()
+    while True:
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.max_wait_ms / 1000
+      while len(batch) < self.max_batch:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      self.batches += 1
+      self.batched_requests += len(batch)
+      try:
+        results = await loop.run_in_executor(None, self.score_batch, [request for request, future in batch])
+        for (request, future), result in zip(batch, results):
+          if not future.done():
+            future.set_result(result)
+      except Exception as e:
+        for request, future in batch:
+          if not future.done():
+            future.set_exception(e)
+
+class RecommendationService:
+
+  max_results = 1000
+
+  def __init__(self, path, max_batch=64, max_wait_ms=2, cache_size=100000, cache_ttl_seconds=300, poll_seconds=1):
+    self.path = path
+    self.poll_seconds = poll_seconds
+    self.cache = ResultCache(cache_size, cache_ttl_seconds)
+    self.latency = {'recommend': LatencyHistogram(), 'similar': LatencyHistogram()}
+    self.recommend_batcher = MicroBatcher(self.score_users, max_batch, max_wait_ms)
+    self.similar_batcher = MicroBatcher(self.score_movies, max_batch, max_wait_ms)
+    self.apply(self.read())
+
+  def read(self):
+    # Copied into memory, so publishing new factors never rewrites files that are still mapped
+    factors = {name: array if name == 'manifest' else np.array(array) for name, array in load_factors(self.path).items()}
+    norms = np.linalg.norm(factors['item_factors'], axis=1, keepdims=True)
+    factors['unit_item_factors'] = factors['item_factors'] / np.maximum(norms, 1e-12)
+    with open('/dbfs%s/movie_titles.json' % self.path) as f:
+      movie_titles = {int(movie_id): title for movie_id, title in json.load(f).items()}
+    return factors, movie_titles, [movie['movieId'] for movie in popular_movies(self.max_results)]
+
+  def apply(self, loaded):
+    # Runs on the event loop thread, so requests see either the old or the new factors and cache, never a mix
+    self.factors, self.movie_titles, self.popular_movie_ids = loaded
+    self.version = self.factors['manifest']['version']
+    self.cache.clear()
+
+  def rows(self, ids, request_ids):
+    request_ids = np.asarray(request_ids, dtype=np.int32)
+    rows = np.minimum(np.searchsorted(ids, request_ids), len(ids) - 1)
+    return rows, ids[rows] == request_ids
+
+  def score_users(self, requests):
+    factors = self.factors
+    rows, known = self.rows(factors['user_ids'], [user_id for user_id, n in requests])
+    k = max(n for user_id, n in requests)
+    known_rows = rows[known]
+
+    # Stack the rated movies of the batch into one CSR, so top_k masks them all at once
+    starts, ends = factors['rated_indptr'][known_rows], factors['rated_indptr'][known_rows + 1]
+    exclude_indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+    exclude_indices = np.concatenate([factors['rated_indices'][s:e] for s, e in zip(starts, ends)] + [np.empty(0, dtype=np.int32)])
+    index, scores = top_k(factors['user_factors'][known_rows], factors['item_factors'], k, exclude_indptr, exclude_indices)
+
+    results, known_iter = [], iter(zip(index, scores))
+    for (user_id, n), is_known in zip(requests, known):
+      if is_known:
+        movie_index, movie_scores = next(known_iter)
+        results.append(self.movies(factors['item_ids'][movie_index[:n]], movie_scores[:n]))
+      else:
+        results.append(self.movies(self.popular_movie_ids[:n]))
+    return results
+
+  def score_movies(self, requests):
+    factors = self.factors
+    rows, known = self.rows(factors['item_ids'], [movie_id for movie_id, n in requests])
+    k = max(n for movie_id, n in requests)
+    known_rows = rows[known]
+    # Each movie is excluded from its own list
+    index, scores = top_k(factors['unit_item_factors'][known_rows], factors['unit_item_factors'], k,
+                          np.arange(len(known_rows) + 1), known_rows)
+
+    results, known_iter = [], iter(zip(index, scores))
+    for (movie_id, n), is_known in zip(requests, known):
+      if is_known:
+        movie_index, movie_scores = next(known_iter)
+        results.append(self.movies(factors['item_ids'][movie_index[:n]], movie_scores[:n]))
+      else:
+        results.append([])
+    return results
+
+  def movies(self, movie_ids, scores=None):
+    return [{'movieId': int(movie_id), 'title': self.movie_titles.get(int(movie_id)),
+             'score': None if scores is None else float(scores[i])} for i, movie_id in enumerate(movie_ids)]
+
+  async def answer(self, endpoint, batcher, key_id, n):
+    start = time.perf_counter()
+    key = (endpoint, key_id, n, self.version)
+    result = self.cache.get(key)
+    if result is None:
+      result = await batcher.submit((key_id, n))
+      self.cache.put(key, result)
+    self.latency[endpoint].observe((time.perf_counter() - start) * 1000)
+    return result
+
+  def metrics(self):
+    lookups = self.cache.hits + self.cache.misses
+    batchers = {'recommend': self.recommend_batcher, 'similar': self.similar_batcher}
+    return {'version': self.version,
+            'latency': {endpoint: histogram.snapshot() for endpoint, histogram in self.latency.items()},
+            'cache': {'size': len(self.cache.entries), 'hits': self.cache.hits, 'misses': self.cache.misses,
+                      'hit_rate': self.cache.hits / lookups if lookups else None},
+            'batches': {name: {'batches': b.batches, 'mean_size': b.batched_requests / b.batches if b.batches else None}
+                        for name, b in batchers.items()}}
+
+  @staticmethod
+  def int_param(params, name, low, high):
+    value = int(params[name])
+    if not low <= value <= high:
+      raise ValueError('%s must be between %s and %s' % (name, low, high))
+    return value
+
+  async def route(self, target):
+    # Parameters are checked before anything is queued, so a bad request never fails the rest of its batch
+    url = urlsplit(target)
+    params = {name: values[0] for name, values in parse_qs(url.query).items()}
+    n = self.int_param(dict({'n': 10}, **params), 'n', 1, self.max_results)
+    if url.path == '/recommend' and 'user' in params:
+      user_id = self.int_param(params, 'user', -2 ** 31, 2 ** 31 - 1)
+      return 200, await self.answer('recommend', self.recommend_batcher, user_id, n)
+    if url.path == '/similar' and 'movie' in params:
+      movie_id = self.int_param(params, 'movie', -2 ** 31, 2 ** 31 - 1)
+      return 200, await self.answer('similar', self.similar_batcher, movie_id, n)
+    if url.path == '/metrics':
+      return 200, self.metrics()
+    return 404, {'error': 'unknown endpoint %s' % url.path}
+
+  async def handle(self, reader, writer):
+    # HTTP/1.1 with keep-alive, so a client can send many requests over one connection
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+          pass
+        try:
+          status, body = await self.route(request_line.decode().split()[1])
+        except (ValueError, IndexError) as e:
+          status, body = 400, {'error': str(e)}
+        except Exception as e:
+          # A scoring failure answers this request with a 500 instead of dropping the connection
+          status, body = 500, {'error': repr(e)}
+        payload = json.dumps(body).encode()
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                     % (status, b'OK' if status == 200 else b'Error', len(payload)) + payload)
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def watch_factors(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(self.poll_seconds)
+      # A failed poll must not end the task, or new factors would never be loaded again
+      try:
+        with open('/dbfs%s/manifest.json' % self.path) as f:
+          version = json.load(f)['version']
+        if version != self.version:
+          self.apply(await loop.run_in_executor(None, self.read))
+          print ('Loaded factors version %s' % self.version)
+      except Exception as e:
+        print ('Polling for new factors failed, keeping version %s: %r' % (self.version, e))
+
+  async def start(self, host='127.0.0.1', port=8765):
+    self.background_tasks = [asyncio.create_task(self.recommend_batcher.run()),
+                             asyncio.create_task(self.similar_batcher.run()),
+                             asyncio.create_task(self.watch_factors())]
+    # Let the batchers create their queues before the first request arrives
+    await asyncio.sleep(0)
+    try:
+      self.server = await asyncio.start_server(self.handle, host, port)
+    except Exception:
+      await self.stop()
+      raise
+
+  async def stop(self):
+    if getattr(self, 'server', None) is not None:
+      self.server.close()
+    # The batchers, the watcher and the handlers of open keep-alive connections
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def start_service(service, host='127.0.0.1', port=8765, timeout=30):
+  # The notebook already runs an event loop, so the service gets its own loop on a background thread.
+  # Returns once the port is bound (a failure to bind is raised here), with a function that stops the service.
+  loop = asyncio.new_event_loop()
+  thread = threading.Thread(target=loop.run_forever, daemon=True)
+  thread.start()
+
+  def stop():
+    asyncio.run_coroutine_threadsafe(service.stop(), loop).result(timeout)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+  try:
+    asyncio.run_coroutine_threadsafe(service.start(host, port), loop).result(timeout)
+  except BaseException:
+    stop()
+    raise
+  return stop
+
+# COMMAND ----------
+
+save_movie_titles(movies_df, factors_path)
+# Running this cell again stops the previous service first, so the new one can bind the port
+if 'stop_service' in globals():
+  stop_service()
+service = RecommendationService(factors_path)
+stop_service = start_service(service)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC A quick load test: many concurrent keep-alive clients request recommendations for random users and similar movies for random movies. The client runs on its own thread and event loop, and the latencies reported come from the service's own histograms.
+
+# COMMAND ----------
+
+async def load_test(n_clients=200, requests_per_client=50, host='127.0.0.1', port=8765):
+  user_ids = factors['user_ids']
+  movie_ids = factors['item_ids']
+
+  async def client(seed):
+    rng = np.random.default_rng(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    for i in range(requests_per_client):
+      if i % 2:
+        target = '/recommend?user=%s&n=10' % rng.choice(user_ids)
+      else:
+        target = '/similar?movie=%s&n=10' % rng.choice(movie_ids)
+      writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (target, host)).encode())
+      await writer.drain()
+      content_length = 0
+      while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+          break
+        if line.lower().startswith(b'content-length:'):
+          content_length = int(line.split(b':')[1])
+      await reader.readexactly(content_length)
+    writer.close()
+
+  start = time.perf_counter()
+  await asyncio.gather(*[client(seed) for seed in range(n_clients)])
+  return n_clients * requests_per_client / (time.perf_counter() - start)
+
+with ThreadPoolExecutor(max_workers=1) as pool:
+  requests_per_second = pool.submit(asyncio.run, load_test()).result()
+print ('%.0f requests per second' % requests_per_second)
+print (json.dumps(service.metrics(), indent=2))